@@ -0,0 +1,92 @@
+"""Compares RedisChatMessageHistory, as previously created for every access, with the compact history store of
+RedisManager: Redis round trips and connections per turn, time per turn and memory used by the stored history.
+
+Needs a running Redis (docker-compose exposes one on port 6380).
+Run from the server directory: python -m benchmarks.chat_history_benchmark --redis-url redis://localhost:6380/0
+"""
+import argparse
+import random
+import time
+
+import redis
+from langchain_community.chat_message_histories import RedisChatMessageHistory
+from langchain_core.messages import AIMessage, HumanMessage
+
+from redis_db import MESSAGE_KEY_PREFIX, RedisManager
+
+WORDS = ("the model answer uses retrieved context from the vector store and cites each source when it is "
+         "relevant to the question asked by the user about redis qdrant embeddings latency streaming").split()
+
+
+class _Counters:
+    round_trips = 0
+    connections = 0
+
+
+def _count_network_calls():
+    """Patches redis-py connections to count packed sends (one per round trip, pipelines included) and sockets
+    opened."""
+    send_packed_command = redis.connection.AbstractConnection.send_packed_command
+
+    def counting_send(self, *args, **kwargs):
+        _Counters.round_trips += 1
+        return send_packed_command(self, *args, **kwargs)
+
+    redis.connection.AbstractConnection.send_packed_command = counting_send
+    for connection_class in (redis.connection.Connection, redis.connection.UnixDomainSocketConnection):
+        def counting_connect(self, _connect=connection_class._connect):
+            _Counters.connections += 1
+            return _connect(self)
+
+        connection_class._connect = counting_connect
+
+
+def _conversation(turns, rng):
+    for _ in range(turns):
+        question = " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 30))) + "?"
+        answer = " ".join(rng.choice(WORDS) for _ in range(rng.randint(40, 700)))
+        if rng.random() < 0.3:
+            answer += "\n```python\n" + "\n".join(f"value_{i} = compute({i})" for i in range(rng.randint(5, 40))) + "\n```"
+        yield HumanMessage(content=question), AIMessage(content=answer)
+
+
+def _memory(client, key):
+    try:
+        return client.memory_usage(key)
+    except redis.ResponseError:
+        return sum(len(entry) for entry in client.lrange(key, 0, -1))
+
+
+def run(name, get_history, client, session_id, turns, seed):
+    client.delete(MESSAGE_KEY_PREFIX + session_id)
+    _Counters.round_trips = _Counters.connections = 0
+    start = time.perf_counter()
+    for question, answer in _conversation(turns, random.Random(seed)):
+        # One chat turn: load the history, then store the question and the answer
+        history = get_history(session_id)
+        _ = history.messages
+        history.add_messages([question, answer])
+    elapsed = time.perf_counter() - start
+    round_trips, connections = _Counters.round_trips, _Counters.connections
+    memory = _memory(client, MESSAGE_KEY_PREFIX + session_id)
+    client.delete(MESSAGE_KEY_PREFIX + session_id)
+    print(f"{name:30} {round_trips / turns:5.2f} round trips/turn  {connections / turns:5.2f} connections/turn  "
+          f"{elapsed / turns * 1000:7.2f} ms/turn  {memory:9} bytes stored")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis-url", default="redis://localhost:6379/0")
+    parser.add_argument("--turns", type=int, default=100)
+    args = parser.parse_args()
+
+    _count_network_calls()
+    redis_manager = RedisManager(redis_url=args.redis_url)
+    run("RedisChatMessageHistory", lambda session_id: RedisChatMessageHistory(session_id, url=args.redis_url),
+        redis_manager.redis, "benchmark_legacy", args.turns, seed=0)
+    run("CompactRedisChatMessageHistory", redis_manager.get_chat_message_history,
+        redis_manager.redis, "benchmark_compact", args.turns, seed=0)
+
+
+if __name__ == '__main__':
+    main()
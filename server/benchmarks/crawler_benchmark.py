@@ -0,0 +1,103 @@
+"""Compares the crawler's previous extraction (BeautifulSoup html.parser, scripts and styles removed) with the
+lxml extraction and near-duplicate suppression, on a synthetic site with site chrome, tracking-parameter links
+and paginated copies of its articles.
+
+Run from the server directory: python -m benchmarks.crawler_benchmark
+"""
+import argparse
+import random
+import time
+
+from bs4 import BeautifulSoup
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from knowledge.near_duplicates import simhash
+from knowledge.web_crawler import WebCrawler
+
+WORDS = ("data model query vector index cluster latency request answer source page crawler token stream "
+         "embedding document context budget cache redis qdrant server client retrieval chunk split").split()
+
+
+def _paragraphs(rng, count):
+    return [" ".join(rng.choice(WORDS) for _ in range(rng.randint(40, 90))).capitalize() + "."
+            for _ in range(count)]
+
+
+def _page(title, paragraphs, footer_note):
+    nav = "".join(f'<li><a href="/section-{i}">Section {i}</a></li>' for i in range(40))
+    body = "".join(f"<p>{paragraph}</p>" for paragraph in paragraphs)
+    return f"""<html><head><title>{title}</title><style>body {{ color: black; }}</style>
+<script>window.dataLayer = [];</script></head><body>
+<header><div class="site-banner">Example docs</div><nav class="main-nav"><ul>{nav}</ul></nav></header>
+<div class="breadcrumbs"><a href="/">Home</a> / <a href="/docs">Docs</a></div>
+<main><article><h1>{title}</h1>{body}<div class="share-buttons">Share on social media</div></article></main>
+<aside class="sidebar"><ul>{nav}</ul></aside>
+<footer><p>Copyright Example. {footer_note}</p><ul>{nav}</ul></footer>
+</body></html>"""
+
+
+def build_site(pages, seed=0):
+    """Returns (url, html) pairs: every article, a tracking-parameter link to it and a paginated copy."""
+    rng = random.Random(seed)
+    site = []
+    for i in range(pages):
+        paragraphs = _paragraphs(rng, rng.randint(5, 15))
+        url = f"https://docs.example.com/article-{i}"
+        site.append((url, _page(f"Article {i}", paragraphs, "Page 1 of 2")))
+        site.append((f"{url}?utm_source=newsletter&utm_medium=email", _page(f"Article {i}", paragraphs, "Page 1 of 2")))
+        site.append((f"{url}?page=2", _page(f"Article {i}", paragraphs, "Page 2 of 2")))
+    return site
+
+
+def baseline(site):
+    texts = []
+    for _, page_html in site:
+        soup = BeautifulSoup(page_html, 'html.parser')
+        for script in soup(["script", "style"]):
+            script.extract()
+        text = soup.get_text()
+        lines = (line.strip() for line in text.splitlines())
+        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+        texts.append('\n'.join(chunk for chunk in chunks if chunk))
+    return texts
+
+
+def optimized(site):
+    crawler = WebCrawler()
+    texts = []
+    for url, page_html in site:
+        url = crawler.normalize_url(url)
+        if url in crawler.seen_urls:
+            continue
+        crawler.seen_urls.add(url)
+        text, _ = crawler.extract(url, page_html)
+        if crawler.duplicate_detector.is_duplicate(simhash(text)):
+            crawler.duplicates_skipped += 1
+        else:
+            texts.append(text)
+    return texts
+
+
+def count_chunks(texts, chunk_size):
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=0, length_function=len,
+                                              is_separator_regex=False)
+    return sum(len(splitter.split_text(text)) for text in texts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=200, help="number of distinct articles on the site")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    site = build_site(args.pages)
+    for name, extract in (("baseline (html.parser)", baseline), ("lxml + dedup", optimized)):
+        start = time.perf_counter()
+        texts = extract(site)
+        elapsed = time.perf_counter() - start
+        print(f"{name:24} {len(site) / elapsed:8.1f} pages/s  {len(texts):5} pages kept  "
+              f"{sum(map(len, texts)):9} characters  {count_chunks(texts, args.chunk_size):6} chunks")
+
+
+if __name__ == '__main__':
+    main()
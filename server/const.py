@@ -25,12 +25,37 @@ class LlmNames(Enum):
 model_registry = {
     LlmNames.CLAUDE_3_HAIKU.value: Llms.ANTHROPIC_HAIKU.value,
     LlmNames.CLAUDE_3_OPUS.value: Llms.ANTHROPIC_OPUS.value,
-    LlmNames.OPENAI_GPT4.value: Llms.ANTHROPIC_SONNET.value,
-    LlmNames.CLAUDE_3_SONNET.value: Llms.OPENAI_GPT4.value,
+    LlmNames.CLAUDE_3_SONNET.value: Llms.ANTHROPIC_SONNET.value,
+    LlmNames.OPENAI_GPT4.value: Llms.OPENAI_GPT4.value,
     LlmNames.OPENAI_GPT4_TURBO.value: Llms.OPENAI_GPT4_TURBO.value,
     LlmNames.OPENAI_GPT3_5_TURBO.value: Llms.OPENAI_GPT3_5.value,
 }
 
+# Equivalent model from the other provider (the registry maps every name to its own
+# provider's client), used to hedge requests whose first token is late and to fail over
+# when a provider errors.
+model_backups = {
+    LlmNames.CLAUDE_3_HAIKU.value: LlmNames.OPENAI_GPT3_5_TURBO.value,
+    LlmNames.OPENAI_GPT3_5_TURBO.value: LlmNames.CLAUDE_3_HAIKU.value,
+    LlmNames.CLAUDE_3_SONNET.value: LlmNames.OPENAI_GPT4_TURBO.value,
+    LlmNames.OPENAI_GPT4_TURBO.value: LlmNames.CLAUDE_3_SONNET.value,
+    LlmNames.CLAUDE_3_OPUS.value: LlmNames.OPENAI_GPT4.value,
+    LlmNames.OPENAI_GPT4.value: LlmNames.CLAUDE_3_OPUS.value,
+}
+
+# Token budget for retrieved context in RAG prompts, per model. Kept well under each
+# context window: larger prompts mostly cost time-to-first-token without improving
+# answers.
+DEFAULT_CONTEXT_TOKEN_BUDGET = 4000
+context_token_budgets = {
+    LlmNames.CLAUDE_3_HAIKU.value: 6000,
+    LlmNames.CLAUDE_3_OPUS.value: 8000,
+    LlmNames.CLAUDE_3_SONNET.value: 8000,
+    LlmNames.OPENAI_GPT4.value: 6000,
+    LlmNames.OPENAI_GPT4_TURBO.value: 8000,
+    LlmNames.OPENAI_GPT3_5_TURBO.value: 3000,
+}
+
 
 class TextSplitters(Enum):
     RECURSIVE_CHARACTER = "recursive_character"
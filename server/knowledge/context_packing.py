@@ -0,0 +1,112 @@
+from typing import List, Sequence
+
+import numpy as np
+
+from knowledge.semantic_chunker import normalize_rows
+
+# Rough characters-per-token ratio shared by the OpenAI and Anthropic tokenizers on English text. Good enough
+# for budgeting without loading a tokenizer per model.
+CHARACTERS_PER_TOKEN = 4
+# Shortest text shared by two chunks of a source that is treated as splitter overlap rather than coincidence
+MIN_OVERLAP_CHARACTERS = 40
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARACTERS_PER_TOKEN + 1
+
+
+def adaptive_cutoff(scores: Sequence[float], relative_threshold: float) -> int:
+    """Number of leading hits (scores sorted in descending order) scoring at least relative_threshold times
+    the best score. Lets a sharp query keep few chunks while a broad one keeps more."""
+    if not scores:
+        return 0
+    minimum = scores[0] * relative_threshold
+    return sum(1 for score in scores if score >= minimum)
+
+
+def remove_duplicates(texts: Sequence[str], vectors: np.ndarray, duplicate_threshold: float) -> List[int]:
+    """Indices of the hits to keep, in order. A hit is dropped when its text is contained in an earlier hit
+    (e.g. the same passage ingested as part of a longer page) or its vector is nearly identical to an earlier
+    kept one. Partial overlaps between neighbouring chunks are left to trim_overlaps."""
+    normalized = normalize_rows(vectors)
+    kept: List[int] = []
+    for i, text in enumerate(texts):
+        stripped = text.strip()
+        if any(stripped in texts[j] for j in kept):
+            continue
+        if kept and np.max(normalized[kept] @ normalized[i]) >= duplicate_threshold:
+            continue
+        kept.append(i)
+    return kept
+
+
+def mmr_select(query_vector: np.ndarray, vectors: np.ndarray, k: int, lambda_mult: float) -> List[int]:
+    """Maximal marginal relevance: greedily picks up to k vectors, trading relevance to the query
+    (lambda_mult = 1) against dissimilarity to the vectors already picked (lambda_mult = 0)."""
+    if len(vectors) == 0 or k <= 0:
+        return []
+    normalized = normalize_rows(vectors)
+    relevance = normalized @ (query_vector / (np.linalg.norm(query_vector) or 1.0))
+    similarity = normalized @ normalized.T
+
+    selected = [int(np.argmax(relevance))]
+    redundancy = similarity[selected[0]].copy()
+    while len(selected) < min(k, len(vectors)):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        redundancy = np.maximum(redundancy, similarity[best])
+    return selected
+
+
+def _overlap(first: str, second: str, min_overlap: int) -> int:
+    """Length of the longest suffix of first that is also a prefix of second, or 0 if shorter than
+    min_overlap."""
+    if min(len(first), len(second)) < min_overlap:
+        return 0
+    head = second[:min_overlap]
+    position = first.find(head)
+    while position != -1:
+        if second.startswith(first[position:]):
+            return len(first) - position
+        position = first.find(head, position + 1)
+    return 0
+
+
+def trim_overlaps(texts: Sequence[str], sources: Sequence[str],
+                  min_overlap: int = MIN_OVERLAP_CHARACTERS) -> List[str]:
+    """Removes from each text what it shares with an earlier text of the same source through the splitter's
+    chunk overlap: a prefix equal to the end of an earlier chunk, or a suffix equal to the start of one (when
+    the later chunk of the source was ranked first). Returns the texts in order; a text left with nothing new
+    becomes empty."""
+    trimmed: List[str] = []
+    for i, text in enumerate(texts):
+        for j in range(i):
+            if sources[j] != sources[i] or not trimmed[j]:
+                continue
+            # Compare with the untrimmed earlier text: its overlap with this one may have been trimmed off
+            prefix = _overlap(texts[j], text, min_overlap)
+            if prefix:
+                text = text[prefix:].lstrip()
+            suffix = _overlap(text, texts[j], min_overlap)
+            if suffix:
+                text = text[:len(text) - suffix].rstrip()
+        trimmed.append(text)
+    return trimmed
+
+
+def pack_to_budget(texts: Sequence[str], token_budget: int) -> List[str]:
+    """Keeps texts, in order, while they fit in the token budget. The first (best ranked) text is always kept,
+    truncated to the budget if needed; later texts that don't fit are skipped so a smaller one further down can
+    still be used."""
+    packed, used = [], 0
+    for text in texts:
+        tokens = estimate_tokens(text)
+        if not packed and tokens > token_budget:
+            text = text[:max(token_budget - 1, 0) * CHARACTERS_PER_TOKEN]
+            tokens = estimate_tokens(text)
+        if used + tokens <= token_budget:
+            packed.append(text)
+            used += tokens
+    return packed
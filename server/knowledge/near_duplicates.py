@@ -0,0 +1,38 @@
+import hashlib
+
+import numpy as np
+
+SHINGLE_SIZE = 3
+# Maximum number of differing bits between two 64-bit fingerprints for their pages to count as duplicates
+MAX_HAMMING_DISTANCE = 3
+
+
+def simhash(text: str, shingle_size: int = SHINGLE_SIZE) -> int:
+    """64-bit SimHash of the word shingles of text. Similar texts get fingerprints differing in few bits."""
+    words = text.lower().split()
+    shingles = {" ".join(words[i:i + shingle_size]) for i in range(max(1, len(words) - shingle_size + 1))}
+    hashes = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little")
+         for shingle in shingles),
+        dtype=np.uint64, count=len(shingles))
+    bits = np.unpackbits(hashes.astype("<u8").view(np.uint8).reshape(-1, 8), axis=1, bitorder="little")
+    majority = bits.sum(axis=0) * 2 > len(shingles)
+    return int.from_bytes(np.packbits(majority, bitorder="little").tobytes(), "little")
+
+
+class NearDuplicateDetector:
+    """Remembers the fingerprints of the pages seen during a crawl and flags pages close to one of them."""
+
+    def __init__(self, max_distance: int = MAX_HAMMING_DISTANCE):
+        self.max_distance = max_distance
+        self.fingerprints = []
+
+    def add(self, fingerprint: int):
+        self.fingerprints.append(fingerprint)
+
+    def is_duplicate(self, fingerprint: int) -> bool:
+        """Returns whether the fingerprint is close to an earlier page's. If it isn't, it is remembered."""
+        if any((fingerprint ^ seen).bit_count() <= self.max_distance for seen in self.fingerprints):
+            return True
+        self.add(fingerprint)
+        return False
@@ -2,6 +2,7 @@ from datetime import datetime
 import uuid
 from typing import Optional, List
 
+import numpy as np
 from langchain_core.callbacks import CallbackManagerForRetrieverRun
 from langchain_core.retrievers import BaseRetriever
 from openai import OpenAI
@@ -10,20 +11,46 @@ from qdrant_client import QdrantClient
 from qdrant_client.http import models
 from qdrant_client.http.models import FieldCondition, MatchText
 from qdrant_client.models import Distance, VectorParams
-from langchain_openai.embeddings import OpenAIEmbeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_experimental.text_splitter import SemanticChunker
 from langchain_core.documents import Document
 
 from const import TextSplitters
+from knowledge.context_packing import adaptive_cutoff, mmr_select, remove_duplicates, trim_overlaps
+from knowledge.semantic_chunker import semantic_chunks
+from metrics import stage
 
 client = OpenAI()
 
+# Limits per embeddings request: the API accepts up to 2048 inputs, but the total token count is capped too.
+EMBEDDING_BATCH_SIZE = 256
+EMBEDDING_BATCH_CHARACTERS = 400_000
+
 
 def get_embedding(text, model="text-embedding-3-small"):
     return client.embeddings.create(input=[text], model=model).data[0].embedding
 
 
+def _embedding_batches(texts: List[str]):
+    batch, batch_characters = [], 0
+    for text in texts:
+        if batch and (len(batch) == EMBEDDING_BATCH_SIZE or batch_characters + len(text) > EMBEDDING_BATCH_CHARACTERS):
+            yield batch
+            batch, batch_characters = [], 0
+        batch.append(text)
+        batch_characters += len(text)
+    if batch:
+        yield batch
+
+
+def get_embeddings(texts: List[str], model="text-embedding-3-small") -> List[List[float]]:
+    """Embeds the texts with as few requests as the batch limits allow, preserving their order."""
+    embeddings = []
+    for batch in _embedding_batches(texts):
+        response = client.embeddings.create(input=batch, model=model)
+        embeddings.extend(x.embedding for x in sorted(response.data, key=lambda x: x.index))
+    return embeddings
+
+
 class QdrantManager:
     def __init__(self, collection_name: str, vector_dim: int = 1536, qdrant_url: str = "http://localhost:6333"):
         self.collection_name = collection_name
@@ -50,12 +77,16 @@ class QdrantManager:
         )
         return [x.page_content for x in text_splitter.create_documents([content])]
 
-    def semantic_chunker_text_splitter(self, content: str, number_of_chunks):
-        text_splitter = SemanticChunker(OpenAIEmbeddings(), number_of_chunks=number_of_chunks)
-        return [x.page_content for x in text_splitter.create_documents([content])]
+    def semantic_chunker_text_splitter(self, content: str, number_of_chunks: Optional[int] = None):
+        """Returns the chunks along with vectors derived from their sentence embeddings."""
+        chunks, vectors = semantic_chunks(content, get_embeddings, number_of_chunks=number_of_chunks)
+        return chunks, vectors.tolist()
 
     def process_content(self, content: str, source: str, context: Optional[str] = None, splitter=None,
-                        splitter_args=None):
+                        splitter_args=None) -> bool:
+        """Splits, embeds and stores content in place of the previous version of source. Returns whether the
+        chunks were written."""
+        content_vectors = None
         if splitter and splitter_args:
             if splitter == TextSplitters.RECURSIVE_CHARACTER.value:
                 expected_keys = {'chunk_size', 'chunk_overlap'}
@@ -65,7 +96,7 @@ class QdrantManager:
             elif splitter == TextSplitters.SEMANTIC_CHUNKER.value:
                 expected_keys = {'number_of_chunks'}
                 filtered_args = {k: int(v) for k, v in splitter_args.items() if k in expected_keys}
-                content_parts = self.semantic_chunker_text_splitter(content, **filtered_args)
+                content_parts, content_vectors = self.semantic_chunker_text_splitter(content, **filtered_args)
 
             else:
                 raise ValueError("Invalid splitter specified.")
@@ -87,12 +118,15 @@ class QdrantManager:
                 points_selector=[result.id for result in search_results[0]]
             )
 
-        content_parts = list(filter(lambda x: x != "", content_parts))
-        points_to_upsert = []
-        for content_part in content_parts:
+        if content_vectors is None or context:
+            content_parts = list(filter(lambda x: x != "", content_parts))
             if context:
-                content_part = f"{context}\n\n{content_part}"
-            embedding = get_embedding(content_part)
+                content_parts = [f"{context}\n\n{content_part}" for content_part in content_parts]
+            # Vectors derived from the sentence embeddings don't cover the context prefix, so embed again here.
+            content_vectors = get_embeddings(content_parts)
+
+        points_to_upsert = []
+        for content_part, embedding in zip(content_parts, content_vectors):
             point_id = str(uuid.uuid4())
             current_datetime = datetime.now().isoformat()
 
@@ -107,15 +141,27 @@ class QdrantManager:
             }
             points_to_upsert.append(point_dict)
 
+        stored = True
         if points_to_upsert:
             try:
                 self.qdrant_client.upsert(collection_name=self.collection_name, points=points_to_upsert)
             except Exception as e:
                 print(e)
+                stored = False
+        return stored
 
 
 class QdrantRetriever(BaseRetriever, metaclass=ModelMetaclass):
+    """Fetches fetch_k candidates, drops weak hits (absolute score_threshold if set, then
+    relative_score_threshold of the best score), removes duplicates and returns at most top_k of them diversified with MMR, without the
+    chunk overlap they share with each other."""
     top_k: int = 5
+    fetch_k: int = 20
+    # text-embedding-3-small scores vary with language and phrasing, so no absolute threshold by default
+    score_threshold: Optional[float] = None
+    relative_score_threshold: float = 0.75
+    duplicate_threshold: float = 0.97
+    mmr_lambda: float = 0.7
     collection_name: str
     qdrant_url:str
 
@@ -127,22 +173,48 @@ class QdrantRetriever(BaseRetriever, metaclass=ModelMetaclass):
             self, query: str, *, run_manager: CallbackManagerForRetrieverRun
     ) -> List[Document]:
         try:
-            encoded_query = get_embedding(query)
-            result = self.qdrant_client.search(
-                collection_name=self.collection_name,
-                query_vector=encoded_query,
-                limit=self.top_k,
-            )
+            with stage("embed_query"):
+                encoded_query = get_embedding(query)
+            with stage("qdrant_search"):
+                qdrant_client = self.qdrant_client
+                result = qdrant_client.search(
+                    collection_name=self.collection_name,
+                    query_vector=encoded_query,
+                    limit=self.fetch_k,
+                    score_threshold=self.score_threshold,
+                )
+                result = result[:adaptive_cutoff([x.score for x in result], self.relative_score_threshold)]
+                vectors = self.get_vectors(qdrant_client, result)
+            with stage("context_selection"):
+                result = self.select_hits(encoded_query, result, vectors)
+                texts = trim_overlaps([x.payload["text"] for x in result], [x.payload["source"] for x in result])
             documents = [Document(
-                page_content=x.payload["text"],
+                page_content=text,
                 metadata={
                     "id": x.id,
                     "score": x.score,
                     "date": x.payload["date"],
                     "source": x.payload["source"],
                 }
-            ) for x in result]
+            ) for x, text in zip(result, texts) if text]
         except Exception as e:
             print(f"Failed to get context: {e}")
             return []
         return documents
+
+    def get_vectors(self, qdrant_client: QdrantClient, hits: list) -> Optional[np.ndarray]:
+        """Vectors of the hits left after the relative cutoff, fetched separately so that the search doesn't
+        return the vectors of every candidate. None when there is nothing to choose between."""
+        if len(hits) < 2:
+            return None
+        points = qdrant_client.retrieve(collection_name=self.collection_name, ids=[x.id for x in hits],
+                                        with_payload=False, with_vectors=True)
+        vectors = {point.id: point.vector for point in points}
+        return np.asarray([vectors[x.id] for x in hits], dtype=np.float32)
+
+    def select_hits(self, query_vector: List[float], hits: list, vectors: Optional[np.ndarray]) -> list:
+        if vectors is None:
+            return hits[:self.top_k]
+        kept = remove_duplicates([x.payload["text"] for x in hits], vectors, self.duplicate_threshold)
+        selected = mmr_select(np.asarray(query_vector, dtype=np.float32), vectors[kept], self.top_k, self.mmr_lambda)
+        return [hits[kept[i]] for i in selected]
@@ -0,0 +1,63 @@
+import re
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+SENTENCE_SPLIT_REGEX = r"(?<=[.?!])\s+"
+BREAKPOINT_PERCENTILE = 95.0
+
+
+def split_sentences(text: str) -> List[str]:
+    sentences = (sentence.strip() for sentence in re.split(SENTENCE_SPLIT_REGEX, text))
+    return [sentence for sentence in sentences if sentence]
+
+
+def combine_sentences(sentences: List[str], buffer_size: int = 1) -> List[str]:
+    """Joins every sentence with its neighbours so each embedding carries a bit of surrounding context."""
+    return [" ".join(sentences[max(0, i - buffer_size):i + buffer_size + 1]) for i in range(len(sentences))]
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+def breakpoint_threshold(distances: np.ndarray, number_of_chunks: Optional[int] = None) -> float:
+    """Distance above which a breakpoint is placed. Without number_of_chunks a fixed percentile is used,
+    otherwise the percentile is interpolated so that roughly number_of_chunks chunks come out (same mapping as
+    langchain_experimental's SemanticChunker)."""
+    if number_of_chunks is None:
+        return float(np.percentile(distances, BREAKPOINT_PERCENTILE))
+    x1, y1 = len(distances), 0.0
+    x2, y2 = 1.0, 100.0
+    x = max(min(number_of_chunks, x1), x2)
+    y = y1 + ((y2 - y1) / (x2 - x1)) * (x - x1) if x1 != x2 else y2
+    return float(np.percentile(distances, min(max(y, 0.0), 100.0)))
+
+
+def semantic_chunks(text: str, embed: Callable[[List[str]], Sequence[Sequence[float]]],
+                    number_of_chunks: Optional[int] = None, buffer_size: int = 1) -> Tuple[List[str], np.ndarray]:
+    """Splits text where the cosine distance between consecutive sentence embeddings peaks.
+
+    Sentences are embedded once, in a single batched call to `embed`. Each chunk's vector is the renormalized
+    mean of its sentence embeddings, so chunks don't need to be embedded again before being stored.
+    Returns the chunk texts and a (number of chunks, dim) matrix of unit vectors.
+    """
+    sentences = split_sentences(text)
+    if not sentences:
+        return [], np.empty((0, 0), dtype=np.float32)
+
+    embeddings = normalize_rows(np.asarray(embed(combine_sentences(sentences, buffer_size)), dtype=np.float32))
+
+    if len(sentences) > 1:
+        distances = 1.0 - np.einsum("ij,ij->i", embeddings[:-1], embeddings[1:])
+        threshold = breakpoint_threshold(distances, number_of_chunks)
+        breakpoints = (np.flatnonzero(distances > threshold) + 1).tolist()
+    else:
+        breakpoints = []
+
+    starts = [0] + breakpoints
+    ends = breakpoints + [len(sentences)]
+    texts = [" ".join(sentences[start:end]) for start, end in zip(starts, ends)]
+    vectors = normalize_rows(np.add.reduceat(embeddings, starts, axis=0))
+    return texts, vectors
@@ -1,17 +1,110 @@
 # web_crawler.py
+import hashlib
+import json
+import re
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urljoin, urlparse, urlunparse
+
 import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin, urlparse
+from lxml import etree, html as lxml_html
+
+from knowledge.near_duplicates import NearDuplicateDetector, simhash
+
+# Elements that never hold the content of a page
+NON_CONTENT_TAGS = ["script", "style", "noscript", "template", "iframe", "svg", "canvas"]
+# Elements that hold navigation and site chrome. Only removed outside of a main content element.
+BOILERPLATE_TAGS = ["nav", "header", "footer", "aside"]
+BOILERPLATE_ROLES = {"navigation", "banner", "contentinfo", "complementary", "search"}
+# Search boxes, newsletter sign-ups etc. Some sites (e.g. ASP.NET WebForms) wrap the whole page in a form, which
+# the text share check below keeps.
+BOILERPLATE_CONTROL_TAGS = {"form", "button"}
+# Whole class or id tokens only: "page-with-sidebar" or "wy-body-for-nav" usually wrap the whole page
+BOILERPLATE_CLASSES = {"nav", "navbar", "navigation", "menu", "footer", "sidebar", "breadcrumb", "breadcrumbs",
+                       "cookie", "cookies", "banner", "share", "social", "ads", "advert", "advertisement", "pagination"}
+# Elements never dropped as boilerplate, whatever their class
+LAYOUT_TAGS = {"html", "body"}
+# An element holding more than this share of the page text is a layout wrapper, not boilerplate
+BOILERPLATE_MAX_TEXT_SHARE = 0.5
+MAIN_CONTENT_XPATHS = ["//main", "//*[@role='main']", "//article"]
+# Elements surrounded with line breaks, so their text doesn't run into the neighbouring blocks
+BLOCK_TAGS = ["p", "div", "section", "article", "main", "li", "ul", "ol", "table", "tr", "td", "th", "br",
+              "h1", "h2", "h3", "h4", "h5", "h6", "pre", "blockquote", "dd", "dt"]
+TRACKING_PARAMETERS = re.compile(r"^(utm_\w+|gclid|fbclid|msclkid|mc_cid|mc_eid|_ga|_gl)$")
+
+SITEMAP_NAMESPACE = {"sm": "http://www.sitemaps.org/schemas/sitemap/0.9"}
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+                  'Chrome/84.0.4147.105 Safari/537.36'
+}
+
+_UTF8_PARSER = lxml_html.HTMLParser(encoding="utf-8")
+_XML_PARSER = etree.XMLParser(resolve_entities=False, no_network=True, recover=True)
+
+
+def ingestion_settings_hash(context=None, splitter=None, splitter_args=None) -> str:
+    """Hash of the settings a page is split and embedded with. Stored with its validators, since an unchanged
+    page still has to be ingested again when these change."""
+    settings = json.dumps([context, splitter, splitter_args or {}], sort_keys=True)
+    return hashlib.sha256(settings.encode("utf-8")).hexdigest()
+
 
 class WebCrawler:
-    def __init__(self, max_links=50):
+    def __init__(self, max_links=50, redis_manager=None, settings_hash=None):
+        """redis_manager, if given, keeps the validators (ETag, Last-Modified, content hashes) of the crawled
+        pages, so that pages unchanged since the previous crawl are not extracted, split and embedded again.
+        settings_hash identifies the ingestion settings (see ingestion_settings_hash); pages last ingested with
+        other settings count as changed."""
         self.max_links = max_links
+        self.redis_manager = redis_manager
+        self.settings_hash = settings_hash or ingestion_settings_hash()
+        self.seen_urls = set()
+        self.duplicate_detector = NearDuplicateDetector()
+        self.duplicates_skipped = 0
+        self.unchanged_urls = set()
+        self.pending_validators: Dict[str, Dict[str, str]] = {}
+        self.sitemap_lastmods: Dict[str, Optional[str]] = {}
+
+    @staticmethod
+    def _is_boilerplate(element) -> bool:
+        if element.tag in LAYOUT_TAGS:
+            return False
+        if element.tag in BOILERPLATE_CONTROL_TAGS or element.get("role") in BOILERPLATE_ROLES:
+            return True
+        tokens = f"{element.get('class', '')} {element.get('id', '')}".lower().split()
+        return any(token in BOILERPLATE_CLASSES for token in tokens)
 
     @staticmethod
-    def clean_text(soup):
-        for script in soup(["script", "style"]):
-            script.extract()
-        text = soup.get_text()
+    def clean_text(document):
+        """Extracts the readable text of a parsed page, dropping scripts, navigation and other boilerplate.
+        Modifies the document."""
+        for element in document.xpath("//" + " | //".join(NON_CONTENT_TAGS)):
+            element.drop_tree()
+
+        main_content = None
+        for xpath in MAIN_CONTENT_XPATHS:
+            candidates = document.xpath(xpath)
+            # Several articles usually mean a listing page, whose content is spread over all of them
+            if len(candidates) == 1:
+                main_content = candidates[0]
+                break
+        if main_content is not None:
+            document = main_content
+        else:
+            for element in document.xpath("//" + " | //".join(BOILERPLATE_TAGS)):
+                element.drop_tree()
+        boilerplate = [element for element in document.iterdescendants()
+                       if isinstance(element.tag, str) and WebCrawler._is_boilerplate(element)]
+        if boilerplate:
+            # Never drop the content along with a wrapper that happens to carry a boilerplate class
+            max_length = len(document.text_content()) * BOILERPLATE_MAX_TEXT_SHARE
+            for element in boilerplate:
+                if element.getparent() is not None and len(element.text_content()) <= max_length:
+                    element.drop_tree()
+
+        for element in document.iter(*BLOCK_TAGS):
+            element.text = "\n" + (element.text or "")
+            element.tail = "\n" + (element.tail or "")
+        text = document.text_content()
         lines = (line.strip() for line in text.splitlines())
         chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
         text = '\n'.join(chunk for chunk in chunks if chunk)
@@ -21,34 +114,166 @@ class WebCrawler:
     def get_domain(url):
         return urlparse(url).netloc
 
+    @staticmethod
+    def normalize_url(url):
+        """Drops the fragment and tracking parameters, so the same page is not fetched once per campaign link."""
+        parsed = urlparse(url)
+        query = [(key, value) for key, value in parse_qsl(parsed.query, keep_blank_values=True)
+                 if not TRACKING_PARAMETERS.match(key)]
+        return urlunparse(parsed._replace(query=urlencode(query), fragment=""))
+
+    def extract(self, url, page_html) -> Tuple[str, List[str]]:
+        """Parses a page with lxml and returns its cleaned text and the absolute URLs it links to."""
+        if not page_html.strip():
+            return "", []
+        document = lxml_html.fromstring(page_html.encode("utf-8"), parser=_UTF8_PARSER)
+        links = [self.normalize_url(urljoin(url, href)) for href in document.xpath("//a/@href")]
+        return self.clean_text(document), links
+
+    def load_validators(self, url) -> Dict[str, str]:
+        if self.redis_manager is None:
+            return {}
+        validators = self.redis_manager.get_crawl_validators(url)
+        if validators.get("settings_hash") != self.settings_hash:
+            # Ingested with other settings: none of the shortcuts for unchanged pages apply
+            return {}
+        return validators
+
+    def save_validators(self, url):
+        """Stores the validators of a page once its content has been ingested, so that the next crawl can skip it
+        while it is unchanged."""
+        validators = self.pending_validators.pop(url, None)
+        if validators is not None and self.redis_manager is not None:
+            self.redis_manager.set_crawl_validators(url, validators)
+
+    def _mark_unchanged(self, url, validators: Dict[str, str], lastmod: Optional[str] = None) -> List[str]:
+        """Records a page as unchanged since the last crawl and returns the links it had then."""
+        self.unchanged_urls.add(url)
+        if lastmod and validators.get("lastmod") != lastmod and self.redis_manager is not None:
+            # Remember the new lastmod so the next crawl can skip the request altogether
+            self.redis_manager.set_crawl_validators(url, {**validators, "lastmod": lastmod})
+        if validators.get("simhash"):
+            self.duplicate_detector.add(int(validators["simhash"]))
+        return json.loads(validators.get("links", "[]"))
+
+    def load_sitemap(self, url, max_sitemaps=10) -> Dict[str, Optional[str]]:
+        """Returns the page URLs listed in the site's sitemap.xml (following sitemap indexes) with their lastmod."""
+        parsed = urlparse(url)
+        sitemaps = [f"{parsed.scheme}://{parsed.netloc}/sitemap.xml"]
+        entries = {}
+        while sitemaps and max_sitemaps > 0:
+            sitemap_url = sitemaps.pop(0)
+            max_sitemaps -= 1
+            try:
+                response = requests.get(sitemap_url, headers=HEADERS, timeout=5)
+                if response.status_code != 200:
+                    continue
+                root = etree.fromstring(response.content, parser=_XML_PARSER)
+            except Exception as e:
+                print(f"Failed to read sitemap {sitemap_url}: {e}")
+                continue
+            if root is None:
+                continue
+            for sitemap in root.findall("sm:sitemap", SITEMAP_NAMESPACE):
+                sitemaps.append(sitemap.findtext("sm:loc", "", SITEMAP_NAMESPACE).strip())
+            for entry in root.findall("sm:url", SITEMAP_NAMESPACE):
+                loc = entry.findtext("sm:loc", "", SITEMAP_NAMESPACE).strip()
+                if loc:
+                    lastmod = entry.findtext("sm:lastmod", None, SITEMAP_NAMESPACE)
+                    entries[self.normalize_url(loc)] = lastmod.strip() if lastmod else None
+        return entries
+
+    def crawl_site(self, url, depth, visited=None, use_sitemap=True):
+        """Crawls from url and then, within the max_links budget, the pages of the site's sitemap. Pages whose
+        sitemap lastmod matches the one recorded at their last ingestion are not fetched at all. Returns the
+        number of pages fetched."""
+        if visited is None:
+            visited = {}
+        crawled_count = [0]
+        url = self.normalize_url(url)
+        domain = self.get_domain(url)
+        if use_sitemap:
+            self.sitemap_lastmods = self.load_sitemap(url)
+        self.crawl(url, depth, visited, domain, crawled_count)
+        for page_url in self.sitemap_lastmods:
+            if crawled_count[0] >= self.max_links:
+                break
+            self.crawl(page_url, 0, visited, domain, crawled_count)
+        return crawled_count[0]
+
+    def visit(self, url, visited) -> Tuple[List[str], bool]:
+        """Fetches a page and stores its text in visited if it changed since the last crawl. Returns its links and
+        whether a request was made."""
+        validators = self.load_validators(url)
+        lastmod = self.sitemap_lastmods.get(url)
+        if lastmod and validators.get("content_hash") and validators.get("lastmod") == lastmod:
+            return self._mark_unchanged(url, validators), False
+
+        headers = dict(HEADERS)
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+        response = requests.get(url, allow_redirects=True, headers=headers, timeout=5)
+        if response.status_code == 304:
+            return self._mark_unchanged(url, validators, lastmod), True
+
+        body_hash = hashlib.sha256(response.content).hexdigest()
+        if validators.get("body_hash") == body_hash:
+            return self._mark_unchanged(url, validators, lastmod), True
+
+        text, links = self.extract(url, response.text)
+        if not text:
+            # Nothing to ingest; the page is fetched again on the next crawl in case its content appears
+            return links, True
+        fingerprint = simhash(text)
+        new_validators = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "lastmod": lastmod,
+            "body_hash": body_hash,
+            "content_hash": hashlib.sha256(text.encode("utf-8")).hexdigest(),
+            "simhash": str(fingerprint),
+            "links": json.dumps(links),
+            "settings_hash": self.settings_hash,
+        }
+        if validators.get("content_hash") == new_validators["content_hash"]:
+            # Only the markup around the content changed; the stored chunks are still valid
+            self.pending_validators[url] = new_validators
+            self.save_validators(url)
+            self._mark_unchanged(url, new_validators)
+        elif self.duplicate_detector.is_duplicate(fingerprint):
+            # Pages differing only in pagination, session parameters etc. are not worth splitting and embedding
+            self.duplicates_skipped += 1
+        else:
+            visited[url] = text
+            self.pending_validators[url] = new_validators
+        return links, True
+
     def crawl(self, url, depth, visited=None, domain=None, crawled_count=None):
         if crawled_count is None:
             crawled_count = [0]
         if visited is None:
             visited = {}
+        url = self.normalize_url(url)
         if domain is None:
             domain = self.get_domain(url)
 
-        if depth < 0 or url in visited or crawled_count[0] >= self.max_links:
+        if depth < 0 or url in visited or url in self.seen_urls or crawled_count[0] >= self.max_links:
             return crawled_count[0]
         try:
             current_domain = self.get_domain(url)
             if current_domain != domain:
                 return crawled_count[0]
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
-                              'Chrome/84.0.4147.105 Safari/537.36'
-            }
-            response = requests.get(url, allow_redirects=True, headers=headers, timeout=5)
-            soup = BeautifulSoup(response.text, 'html.parser')
-            visited[url] = self.clean_text(soup)
-            crawled_count[0] += 1
-
-            for link in soup.find_all('a', href=True):
-                print(link)
+            self.seen_urls.add(url)
+            links, fetched = self.visit(url, visited)
+            # Pages skipped thanks to their sitemap lastmod cost nothing, so they don't use up the budget
+            if fetched:
+                crawled_count[0] += 1
+
+            for full_url in links:
                 if crawled_count[0] >= self.max_links:
                     break
-                full_url = urljoin(url, link['href'])
                 self.crawl(full_url, depth-1, visited, domain, crawled_count)
         except Exception as e:
             print(f"Failed to visit {url}: {e}")
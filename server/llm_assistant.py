@@ -5,19 +5,27 @@ from langchain.agents import create_openai_functions_agent, AgentExecutor
 from langchain_core.chat_history import BaseChatMessageHistory
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder, PromptTemplate
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.runnables import RunnableConfig, RunnablePassthrough
 from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_community.chat_message_histories import RedisChatMessageHistory
 import langchain_anthropic.chat_models as cm
 
+from knowledge.context_packing import pack_to_budget
 from knowledge.qdrant import QdrantRetriever
-from redis_db import RedisManager
+from llm_cache import response_cache
+from metrics import ANSWER_TAG, NULL_TRACE, RequestTrace, TraceCallbackHandler, activate
+from model_router import ModelRouter
+from redis_db import CompactRedisChatMessageHistory, RedisManager
 
-os.environ['LANGCHAIN_TRACING_V2'] = 'true'
+# LangSmith tracing is only useful (and only reachable) when an API key is configured. Local per-stage timings
+# are collected by the metrics module regardless.
+os.environ.setdefault('LANGCHAIN_TRACING_V2', 'true' if os.getenv('LANGCHAIN_API_KEY') else 'false')
 
-from const import model_registry
+from const import DEFAULT_CONTEXT_TOKEN_BUDGET, context_token_budgets, model_backups, model_registry
 from tools.news_tool import get_news_article
 
+# Shared by all requests, so that hedging decisions use the latency observed across them
+model_router = ModelRouter(model_registry, model_backups)
+
 # Temporary fix for a bug in langchain related to message type lookups.
 # This fix assigns correct roles (user or assistant) to message chunks based on their origin.
 cm._message_type_lookups = {
@@ -63,16 +71,19 @@ class LLMAssistant:
         self.session_id = session_id
         self.chat_prompt = _init_chat_prompt()
 
-    def get_message_history(self, session_id: Optional[str] = None) -> RedisChatMessageHistory:
+    def get_message_history(self, session_id: Optional[str] = None) -> CompactRedisChatMessageHistory:
         """Retrieves the message history for a given session from Redis."""
         if session_id is None:
             session_id = self.session_id
         return self.redis_manager.get_chat_message_history(session_id)
 
-    def stream_response(self, input_text: str, qdrant_retriever: QdrantRetriever, use_rag = False):
-        """Streams responses from the language model for the given input text, utilizing the chat history."""
-        model = model_registry[self.model_name]
-        rag_chain = self.chat_prompt | model
+    def stream_response(self, input_text: str, qdrant_retriever: QdrantRetriever, use_rag = False,
+                        trace: RequestTrace = NULL_TRACE):
+        """Streams responses from the language model for the given input text, utilizing the chat history.
+        Stage timings and token counts are recorded on the given trace."""
+        model = model_router.get(self.model_name)
+        answer_model = response_cache.wrap(model.with_config(tags=[ANSWER_TAG]))
+        rag_chain = self.chat_prompt | answer_model
         def get_history_callable(session_id: str) -> BaseChatMessageHistory:
             return self.get_message_history(session_id)
 
@@ -87,6 +98,10 @@ class LLMAssistant:
                 formatted_doc = f"Date: {date}\nSource: {source}\n\n{doc.page_content}"
                 formatted_docs.append(formatted_doc)
 
+            # Keep the documents, already ordered by relevance, that fit in the model's context budget
+            token_budget = context_token_budgets.get(self.model_name, DEFAULT_CONTEXT_TOKEN_BUDGET)
+            formatted_docs = pack_to_budget(formatted_docs, token_budget)
+
             # Join all formatted documents with a separator
             return "\n\n----------------\n\n".join(formatted_docs)
 
@@ -103,7 +118,7 @@ class LLMAssistant:
                     MessagesPlaceholder(variable_name="agent_scratchpad"),
                 ]
             )
-            contextualize_q_chain = contextualize_q_prompt | model | StrOutputParser()
+            contextualize_q_chain = contextualize_q_prompt | response_cache.wrap(model) | StrOutputParser()
 
             qa_system_prompt = """You are an assistant for question-answering tasks. \
 Use the following pieces of retrieved context to answer the question. \
@@ -119,9 +134,10 @@ If you don't know the answer, just say that you don't know. \
                 ]
             )
 
-            def contextualized_question(input: dict):
+            def contextualized_question(input: dict, config: RunnableConfig):
                 if input.get("history"):
-                    return contextualize_q_chain
+                    with trace.stage("contextualize"):
+                        return contextualize_q_chain.invoke(input, config)
                 else:
                     return input["input"]
 
@@ -130,7 +146,7 @@ If you don't know the answer, just say that you don't know. \
                         context=contextualized_question | qdrant_retriever | format_docs
                     )
                     | qa_prompt
-                    | model
+                    | answer_model
             )
 
         with_message_history = RunnableWithMessageHistory(
@@ -140,13 +156,21 @@ If you don't know the answer, just say that you don't know. \
             history_messages_key="history",
         )
 
-        for response in with_message_history.stream({"input": input_text, "agent_scratchpad": []},
-                                                    config={"configurable": {"session_id": self.session_id}}):
-            yield response.content
+        config = {"configurable": {"session_id": self.session_id}}
+        if trace.sampled:
+            config["callbacks"] = [TraceCallbackHandler(trace)]
 
+        activate(trace)
+        try:
+            for response in with_message_history.stream({"input": input_text, "agent_scratchpad": []}, config=config):
+                yield response.content
+        finally:
+            trace.finish()
+            activate(NULL_TRACE)
 
 
-    def stream_response_agent(self, input_text: str, qdrant_retriever: QdrantRetriever, use_rag=False):
+    def stream_response_agent(self, input_text: str, qdrant_retriever: QdrantRetriever, use_rag=False,
+                              trace: RequestTrace = NULL_TRACE):
         """Streams responses from the language model for the given input text, utilizing the chat history."""
         self.chat_prompt = _init_chat_prompt(True)
         model = model_registry[self.model_name]
@@ -164,24 +188,30 @@ If you don't know the answer, just say that you don't know. \
         )
         output_lines = ""
         function_invocations = []
-        for chunk in agent_with_chat_history.stream({"input": input_text},
-                                                    config={"configurable": {"session_id": self.session_id}}):
-            if 'actions' in chunk:
-                for action in chunk['actions']:
-                    function_invocations.append("working...\n")
+        activate(trace)
+        try:
+            for chunk in agent_with_chat_history.stream({"input": input_text},
+                                                        config={"configurable": {"session_id": self.session_id}}):
+                if 'actions' in chunk:
+                    for action in chunk['actions']:
+                        function_invocations.append("working...\n")
+
+                if 'output' in chunk:
+                    # Add the final output to the log
+                    function_invocations = []
+                    final_output = f"{chunk['output']}"
+                    function_invocations.append(final_output)
 
-            if 'output' in chunk:
-                # Add the final output to the log
-                function_invocations = []
-                final_output = f"{chunk['output']}"
-                function_invocations.append(final_output)
+                output_lines += "<br>\n".join(function_invocations)
 
-            output_lines += "<br>\n".join(function_invocations)
+                # Reset for the next chunk
 
-            # Reset for the next chunk
 
+                yield output_lines
+        finally:
+            trace.finish()
+            activate(NULL_TRACE)
 
-            yield output_lines
     def set_session_id(self, new_session_id: str):
         """Updates the session identifier for the assistant."""
         self.session_id = new_session_id
@@ -0,0 +1,140 @@
+import hashlib
+import json
+from typing import Iterator, List, Optional, Tuple
+
+import redis
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.prompt_values import PromptValue
+from langchain_core.runnables import Runnable, RunnableConfig
+
+from metrics import registry
+
+CACHE_KEY_PREFIX = "llm_cache:"
+# Incremented whenever sources are ingested. Entries store the generation they were created in and are ignored
+# once it is outdated, so invalidation is a single INCR; stale entries simply expire with their TTL.
+GENERATION_KEY = "llm_cache_generation"
+# Size of the pieces a cached answer is replayed in, so the frontend renders it as it does a live stream.
+REPLAY_CHUNK_SIZE = 24
+
+
+def _render_prompt(input) -> List[List[str]]:
+    if isinstance(input, PromptValue):
+        messages = input.to_messages()
+    elif isinstance(input, str):
+        return [["human", input]]
+    else:
+        messages = input
+    return [[message.type, json.dumps(message.content, sort_keys=True)] for message in messages]
+
+
+def _model_identity(model) -> str:
+    name = getattr(model, "model_name", None) or getattr(model, "model", "")
+    return f"{type(model).__name__}:{name}"
+
+
+class ResponseCache:
+    """Redis cache of complete model answers, keyed by model and fully rendered prompt. Disabled until
+    configured with a positive TTL. Only temperature-0 models are cached, since only their answers are
+    (nearly) deterministic."""
+
+    def __init__(self):
+        self.redis: Optional[redis.Redis] = None
+        self.ttl = 0
+
+    def configure(self, redis_client: redis.Redis, ttl: int):
+        self.redis = redis_client
+        self.ttl = ttl
+
+    @property
+    def enabled(self) -> bool:
+        return self.redis is not None and self.ttl > 0
+
+    def key(self, model, input) -> str:
+        payload = json.dumps([_model_identity(model), _render_prompt(input)])
+        return CACHE_KEY_PREFIX + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Tuple[Optional[int], Optional[str]]:
+        """Returns the current generation and the cached answer, if there is one from this generation. Both are
+        read in a single round trip. The generation is None if Redis could not be read."""
+        try:
+            generation, cached = self.redis.mget(GENERATION_KEY, key)
+        except redis.RedisError as e:
+            print(f"Failed to read LLM cache: {e}")
+            return None, None
+        generation = int(generation or 0)
+        if cached is None:
+            return generation, None
+        cached_generation, _, text = cached.partition(b"\n")
+        if int(cached_generation) != generation:
+            return generation, None
+        return generation, text.decode("utf-8")
+
+    def set(self, key: str, generation: Optional[int], text: str):
+        if generation is None:
+            return
+        try:
+            self.redis.set(key, f"{generation}\n".encode("utf-8") + text.encode("utf-8"), ex=self.ttl)
+        except redis.RedisError as e:
+            print(f"Failed to write LLM cache: {e}")
+
+    def invalidate(self):
+        """Outdates every cached answer. Called when sources are (re-)ingested, since answers may depend on them."""
+        if not self.enabled:
+            return
+        try:
+            self.redis.incr(GENERATION_KEY)
+        except redis.RedisError as e:
+            print(f"Failed to invalidate LLM cache: {e}")
+
+    def wrap(self, model):
+        """Returns the model wrapped with this cache, or the model itself if caching doesn't apply."""
+        bound = getattr(model, "bound", model)
+        if not self.enabled or getattr(bound, "temperature", None) != 0:
+            return model
+        return CachedChatModel(model=model, cache=self)
+
+
+response_cache = ResponseCache()
+
+
+class CachedChatModel(Runnable[PromptValue, BaseMessage]):
+    """Serves a chat model's answers from the response cache. Hits are replayed as a stream of chunks. A routed
+    model is cached under the model picked by the user, even when its hedge or failover backup answered, as the
+    router treats the two as equivalent."""
+
+    def __init__(self, model: Runnable, cache: ResponseCache):
+        self.model = model
+        self.cache = cache
+        self.model_identity = _model_identity(getattr(model, "bound", model))
+
+    def _lookup(self, input):
+        key = self.cache.key(getattr(self.model, "bound", self.model), input)
+        generation, cached = self.cache.get(key)
+        registry.inc("bizartvisor_llm_cache_requests_total", model=self.model_identity,
+                     result="miss" if cached is None else "hit")
+        return key, generation, cached
+
+    def invoke(self, input, config: Optional[RunnableConfig] = None, **kwargs) -> BaseMessage:
+        key, generation, cached = self._lookup(input)
+        if cached is not None:
+            return AIMessage(content=cached)
+        message = self.model.invoke(input, config, **kwargs)
+        if isinstance(message.content, str) and message.content:
+            self.cache.set(key, generation, message.content)
+        return message
+
+    def stream(self, input, config: Optional[RunnableConfig] = None, **kwargs) -> Iterator[BaseMessage]:
+        key, generation, cached = self._lookup(input)
+        if cached is not None:
+            for start in range(0, len(cached), REPLAY_CHUNK_SIZE):
+                yield AIMessageChunk(content=cached[start:start + REPLAY_CHUNK_SIZE])
+            return
+
+        parts = []
+        for chunk in self.model.stream(input, config, **kwargs):
+            if isinstance(chunk.content, str):
+                parts.append(chunk.content)
+            yield chunk
+        # Only complete answers are stored; an interrupted stream never reaches this point.
+        if parts:
+            self.cache.set(key, generation, "".join(parts))
@@ -0,0 +1,234 @@
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Dict, Optional, Sequence, Tuple
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+# Fraction of requests that get a trace. Unsampled requests use NULL_TRACE, whose methods do nothing.
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '1.0'))
+
+# Tag attached to the model that produces the user-facing answer, so the contextualization call is not
+# mistaken for it when measuring time-to-first-token.
+ANSWER_TAG = "answer"
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKENS_PER_SECOND_BUCKETS = (5.0, 10.0, 20.0, 40.0, 80.0, 160.0, 320.0)
+
+
+def _escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], extra: str = "") -> str:
+    parts = [f'{key}="{_escape_label(value)}"' for key, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class MetricsRegistry:
+    """In-process store of counters and histograms, rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[tuple, float]] = {}
+        self._histograms: Dict[str, Dict[tuple, list]] = {}
+        self._buckets: Dict[str, Sequence[float]] = {}
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, buckets: Sequence[float] = DURATION_BUCKETS, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            bounds = self._buckets.setdefault(name, buckets)
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = [[0] * len(bounds), 0.0, 0]
+            for i, bound in enumerate(bounds):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                for labels, value in series.items():
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+            for name, series in sorted(self._histograms.items()):
+                bounds = self._buckets[name]
+                lines.append(f"# TYPE {name} histogram")
+                for labels, (counts, total, count) in series.items():
+                    label_text = _format_labels(labels)
+                    for bound, bucket_count in zip(bounds, counts):
+                        bucket_labels = _format_labels(labels, 'le="%s"' % bound)
+                        lines.append(f"{name}_bucket{bucket_labels} {bucket_count}")
+                    inf_labels = _format_labels(labels, 'le="+Inf"')
+                    lines.append(f"{name}_bucket{inf_labels} {count}")
+                    lines.append(f"{name}_sum{label_text} {total}")
+                    lines.append(f"{name}_count{label_text} {count}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+class RequestTrace:
+    """Collects the stage timings and token counts of a single request and publishes them when finished."""
+
+    sampled = True
+
+    def __init__(self, route: str, model: str = "", metrics_registry: MetricsRegistry = registry):
+        self.route = route
+        self.model = model
+        self.registry = metrics_registry
+        self.started = time.perf_counter()
+        self.durations: Dict[str, float] = {}
+        self.output_tokens = 0
+        self._lock = threading.Lock()
+        self._finished = False
+
+    def record(self, stage_name: str, seconds: float):
+        """Adds time to a stage. Stages hit several times in a request (e.g. history writes) are summed."""
+        with self._lock:
+            self.durations[stage_name] = self.durations.get(stage_name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, stage_name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage_name, time.perf_counter() - start)
+
+    def add_output_tokens(self, count: int):
+        with self._lock:
+            self.output_tokens += count
+
+    def server_timing(self) -> str:
+        """Formats the stages recorded so far as a Server-Timing header value (durations in milliseconds)."""
+        with self._lock:
+            durations = list(self.durations.items())
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in durations)
+
+    def finish(self):
+        """Records the total duration and publishes the trace to the registry. Later calls are ignored."""
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+        self.record("total", time.perf_counter() - self.started)
+
+        labels = {"route": self.route, "model": self.model}
+        self.registry.inc("bizartvisor_requests_total", **labels)
+        for stage_name, seconds in self.durations.items():
+            self.registry.observe("bizartvisor_stage_duration_seconds", seconds, stage=stage_name, **labels)
+        if self.output_tokens:
+            self.registry.inc("bizartvisor_llm_output_tokens_total", self.output_tokens, **labels)
+            generation = self.durations.get("generation")
+            if generation:
+                self.registry.observe("bizartvisor_llm_tokens_per_second", self.output_tokens / generation,
+                                      buckets=TOKENS_PER_SECOND_BUCKETS, **labels)
+
+
+class _NullTrace(RequestTrace):
+    """Trace used for unsampled requests; every method is a no-op."""
+
+    sampled = False
+
+    def __init__(self):
+        super().__init__(route="", model="")
+
+    def record(self, stage_name: str, seconds: float):
+        pass
+
+    def stage(self, stage_name: str):
+        return nullcontext()
+
+    def add_output_tokens(self, count: int):
+        pass
+
+    def server_timing(self) -> str:
+        return ""
+
+    def finish(self):
+        pass
+
+
+NULL_TRACE = _NullTrace()
+
+_current_trace: ContextVar[RequestTrace] = ContextVar("current_trace", default=NULL_TRACE)
+
+
+def start_trace(route: str, model: str = "") -> RequestTrace:
+    """Returns a new trace for the request, or NULL_TRACE if the request is not sampled."""
+    if TRACE_SAMPLE_RATE >= 1.0 or random.random() < TRACE_SAMPLE_RATE:
+        return RequestTrace(route, model)
+    return NULL_TRACE
+
+
+def activate(trace: RequestTrace):
+    """Makes the trace visible to stage() calls in code that does not receive it explicitly, such as the
+    retriever and the chat history store."""
+    _current_trace.set(trace)
+
+
+def stage(stage_name: str):
+    """Times a block against the active trace, if any."""
+    return _current_trace.get().stage(stage_name)
+
+
+class TraceCallbackHandler(BaseCallbackHandler):
+    """LangChain callback handler that measures time-to-first-token, generation time and streamed tokens of
+    the answer model. Each streamed chunk is counted as one token. Time-to-first-token runs from the start of
+    the first answer model of the request, so that when a request is hedged or fails over, the time spent on
+    the model that was given up on is included."""
+
+    def __init__(self, trace: RequestTrace):
+        self.trace = trace
+        self._ttft_recorded = False
+        self._first_start: Optional[float] = None
+        self._starts: Dict = {}
+        self._first_tokens: Dict = {}
+        self._tokens: Dict = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, tags: Optional[list] = None, **kwargs):
+        if ANSWER_TAG in (tags or []):
+            self._starts[run_id] = time.perf_counter()
+            if self._first_start is None:
+                self._first_start = self._starts[run_id]
+
+    def on_llm_new_token(self, token: str, *, run_id, **kwargs):
+        if run_id not in self._starts:
+            return
+        if run_id not in self._first_tokens:
+            now = time.perf_counter()
+            self._first_tokens[run_id] = now
+            if not self._ttft_recorded:
+                self._ttft_recorded = True
+                self.trace.record("ttft", now - self._first_start)
+        self._tokens[run_id] = self._tokens.get(run_id, 0) + 1
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        if self._starts.pop(run_id, None) is None:
+            return
+        first_token = self._first_tokens.pop(run_id, None)
+        if first_token is not None:
+            self.trace.record("generation", time.perf_counter() - first_token)
+        self.trace.add_output_tokens(self._tokens.pop(run_id, 0))
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._starts.pop(run_id, None)
+        self._first_tokens.pop(run_id, None)
+        self._tokens.pop(run_id, None)
@@ -0,0 +1,179 @@
+import queue
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Iterator, Optional
+
+import numpy as np
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.prompt_values import PromptValue
+from langchain_core.runnables import Runnable, RunnableConfig
+
+from metrics import registry
+
+# End of a worker's stream
+_DONE = object()
+
+
+class LatencyTracker:
+    """Rolling window of time-to-first-token samples per model, used to decide when a request is late."""
+
+    def __init__(self, window: int = 50, min_samples: int = 5, percentile: float = 95.0,
+                 default_delay: float = 4.0, min_delay: float = 0.5, max_delay: float = 10.0):
+        self.window = window
+        self.min_samples = min_samples
+        self.percentile = percentile
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self._samples: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, model_name: str, ttft: float):
+        with self._lock:
+            self._samples.setdefault(model_name, deque(maxlen=self.window)).append(ttft)
+        registry.observe("bizartvisor_model_ttft_seconds", ttft, model=model_name)
+
+    def record_lower_bound(self, model_name: str, ttft: float):
+        """Records the time a request was given up on before its first token, which its TTFT is at least. Only
+        kept when above the model's current percentile: lower bounds below it would drag the tail down."""
+        with self._lock:
+            samples = self._samples.setdefault(model_name, deque(maxlen=self.window))
+            if not samples or ttft > np.percentile(samples, self.percentile):
+                samples.append(ttft)
+
+    def hedge_delay(self, model_name: str) -> float:
+        """Seconds to wait for the first token before hedging: the model's recent tail latency, clamped."""
+        with self._lock:
+            samples = list(self._samples.get(model_name, ()))
+        if len(samples) < self.min_samples:
+            return self.default_delay
+        delay = float(np.percentile(samples, self.percentile))
+        return min(max(delay, self.min_delay), self.max_delay)
+
+
+class _StreamWorker:
+    """Consumes a model stream on a background thread and forwards its chunks to a shared queue."""
+
+    def __init__(self, model_name: str, model: Runnable, input, config: Optional[RunnableConfig],
+                 events: queue.Queue):
+        self.model_name = model_name
+        self.started = time.perf_counter()
+        self.finished = False
+        self._cancelled = threading.Event()
+        self._events = events
+        threading.Thread(target=self._run, args=(model, input, config), daemon=True).start()
+
+    def cancel(self):
+        """Stops forwarding chunks. A read blocked in the HTTP client can't be interrupted from another thread,
+        so the stream, and with it the provider's response, is closed when its next chunk arrives; a request
+        not sent yet is not sent at all."""
+        self._cancelled.set()
+
+    def _run(self, model: Runnable, input, config: Optional[RunnableConfig]):
+        stream = None
+        try:
+            if self._cancelled.is_set():
+                return
+            stream = model.stream(input, config)
+            for chunk in stream:
+                if self._cancelled.is_set():
+                    return
+                self._events.put((self, chunk))
+            self._events.put((self, _DONE))
+        except Exception as e:
+            self._events.put((self, e))
+        finally:
+            if stream is not None:
+                stream.close()
+
+
+class RoutedChatModel(Runnable[PromptValue, BaseMessage]):
+    """Streams from the primary model and, if its first token is later than its usual tail latency, also from
+    an equivalent backup model. The first to produce a token is used; the other one's chunks are discarded and
+    its stream is closed at its next chunk, which bounds what it generates but not the wait for it. Errors
+    before the first token fail over to the backup; errors after it are raised, since part of the answer has
+    already been sent."""
+
+    def __init__(self, model_name: str, models: Dict[str, Runnable], backup_name: Optional[str],
+                 tracker: LatencyTracker, hedging: bool = True):
+        self.model_name = model_name
+        self.models = models
+        self.backup_name = backup_name if backup_name in models else None
+        self.tracker = tracker
+        self.hedging = hedging
+        self.temperature = getattr(models[model_name], "temperature", None)
+
+    def invoke(self, input, config: Optional[RunnableConfig] = None, **kwargs) -> BaseMessage:
+        return AIMessage(content="".join(chunk.content for chunk in self.stream(input, config, **kwargs)))
+
+    def stream(self, input, config: Optional[RunnableConfig] = None, **kwargs) -> Iterator[BaseMessage]:
+        events = queue.Queue()
+        workers = [_StreamWorker(self.model_name, self.models[self.model_name], input, config, events)]
+        hedge_at = workers[0].started + self.tracker.hedge_delay(self.model_name)
+
+        def start_backup(reason: str):
+            registry.inc(f"bizartvisor_router_{reason}_total", model=self.model_name, backup=self.backup_name)
+            workers.append(_StreamWorker(self.backup_name, self.models[self.backup_name], input, config, events))
+
+        try:
+            winner = None
+            while winner is None:
+                can_hedge = self.hedging and self.backup_name and len(workers) == 1
+                try:
+                    worker, item = events.get(timeout=max(0.0, hedge_at - time.perf_counter()) if can_hedge else None)
+                except queue.Empty:
+                    start_backup("hedges")
+                    continue
+
+                if isinstance(item, Exception):
+                    worker.finished = True
+                    print(f"Model {worker.model_name} failed before its first token: {item}")
+                    registry.inc("bizartvisor_router_errors_total", model=worker.model_name)
+                    if self.backup_name and len(workers) == 1:
+                        start_backup("failovers")
+                    elif all(w.finished for w in workers):
+                        raise item
+                    continue
+
+                winner = worker
+                now = time.perf_counter()
+                self.tracker.record(winner.model_name, now - winner.started)
+                for loser in workers:
+                    if loser is not winner and not loser.finished:
+                        loser.cancel()
+                        # A backup that lost only ran for the hedge's head start, which says nothing about its
+                        # latency. A primary that lost is at least this slow.
+                        if loser.model_name == self.model_name:
+                            self.tracker.record_lower_bound(loser.model_name, now - loser.started)
+                if item is _DONE:
+                    return
+                yield item
+
+            while True:
+                worker, item = events.get()
+                if worker is not winner:
+                    continue
+                if item is _DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+
+class ModelRouter:
+    """Builds RoutedChatModels for the UI model names, sharing one latency tracker between requests."""
+
+    def __init__(self, models: Dict[str, Runnable], backups: Dict[str, str],
+                 tracker: Optional[LatencyTracker] = None, hedging: bool = True):
+        self.models = models
+        self.backups = backups
+        self.tracker = tracker or LatencyTracker()
+        self.hedging = hedging
+
+    def get(self, model_name: str) -> RoutedChatModel:
+        return RoutedChatModel(model_name, self.models, self.backups.get(model_name), self.tracker,
+                               hedging=self.hedging)
@@ -1,6 +1,83 @@
+import json
+
+import msgpack
 import redis
-from typing import List
-from langchain_community.chat_message_histories import RedisChatMessageHistory
+from typing import Dict, List, Sequence
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, message_to_dict, \
+    messages_from_dict
+
+from metrics import stage
+
+try:
+    import zstandard
+except ImportError:  # Long answers are then stored uncompressed
+    zstandard = None
+
+MESSAGE_KEY_PREFIX = "message_store:"
+# AI answers at least this long (in characters) are zstd-compressed
+COMPRESSION_MIN_LENGTH = 1024
+
+_MESSAGE_CODES = {
+    "human": 0, "HumanMessageChunk": 0,
+    "ai": 1, "AIMessageChunk": 1,
+    "system": 2, "SystemMessageChunk": 2,
+}
+_MESSAGE_CLASSES = [HumanMessage, AIMessage, SystemMessage]
+
+
+def encode_message(message: BaseMessage) -> bytes:
+    """Packs a message as a msgpack [type code, content] pair. Compressed content is stored as binary and plain
+    content as a string, so no flag is needed. Messages without a compact form are stored as JSON."""
+    code = _MESSAGE_CODES.get(message.type)
+    if code is None or not isinstance(message.content, str) or message.additional_kwargs:
+        return json.dumps(message_to_dict(message)).encode("utf-8")
+    content = message.content
+    if zstandard is not None and code == 1 and len(content) >= COMPRESSION_MIN_LENGTH:
+        content = zstandard.ZstdCompressor().compress(content.encode("utf-8"))
+    return msgpack.packb([code, content], use_bin_type=True)
+
+
+def decode_message(data: bytes) -> BaseMessage:
+    # JSON entries come from RedisChatMessageHistory or from messages without a compact form. A msgpack array
+    # never starts with "{".
+    if data[:1] == b"{":
+        return messages_from_dict([json.loads(data)])[0]
+    code, content = msgpack.unpackb(data, raw=False)
+    if isinstance(content, bytes):
+        content = zstandard.ZstdDecompressor().decompress(content).decode("utf-8")
+    return _MESSAGE_CLASSES[code](content=content)
+
+
+class CompactRedisChatMessageHistory(BaseChatMessageHistory):
+    """Chat history kept in a Redis list, newest message first, like RedisChatMessageHistory (whose entries are
+    still readable). Messages are msgpack-encoded and long AI answers compressed. It uses the caller's Redis
+    client, hence its connection pool, and stores all messages of a turn with a single command."""
+
+    def __init__(self, redis_client: redis.Redis, session_id: str, key_prefix: str = MESSAGE_KEY_PREFIX):
+        self.redis = redis_client
+        self.session_id = session_id
+        self.key_prefix = key_prefix
+
+    @property
+    def key(self) -> str:
+        return self.key_prefix + self.session_id
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        with stage("history_load"):
+            entries = self.redis.lrange(self.key, 0, -1)
+        return [decode_message(entry) for entry in reversed(entries)]
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        if not messages:
+            return
+        with stage("history_save"):
+            # LPUSH inserts its values one after the other at the head, so the last message ends up first
+            self.redis.lpush(self.key, *[encode_message(message) for message in messages])
+
+    def clear(self) -> None:
+        self.redis.delete(self.key)
 
 
 class RedisManager:
@@ -15,12 +92,31 @@ class RedisManager:
         Retrieves the history of conversations stored in Redis.
         Returns a list of conversation identifiers.
         """
-        history_items = [key.decode('utf-8').split(":", 1)[1] for key in self.redis.scan_iter("message_store:*")]
+        history_items = [key.decode('utf-8').split(":", 1)[1] for key in self.redis.scan_iter(f"{MESSAGE_KEY_PREFIX}*")]
         return history_items
 
-    def get_chat_message_history(self, session_id: str) -> RedisChatMessageHistory:
+    def get_chat_message_history(self, session_id: str) -> CompactRedisChatMessageHistory:
         """
         Retrieves chat message history for a given session.
-        Assumes RedisChatMessageHistory can be initialized with session_id and works with the current Redis connection.
+        The history shares this manager's Redis connection pool instead of opening its own.
+        """
+        return CompactRedisChatMessageHistory(self.redis, session_id)
+
+    def get_crawl_validators(self, url: str) -> Dict[str, str]:
+        """
+        Retrieves what was recorded about a web page when it was last ingested: ETag, Last-Modified, sitemap lastmod,
+        hashes of its body and text, its SimHash fingerprint, its links and the hash of the ingestion settings.
+        Empty if the page is unknown.
+        """
+        validators = self.redis.hgetall(f"crawl_validators:{url}")
+        return {key.decode('utf-8'): value.decode('utf-8') for key, value in validators.items()}
+
+    def set_crawl_validators(self, url: str, validators: Dict[str, str]):
+        """
+        Replaces the validators recorded for a web page. Missing (None) values are not stored.
         """
-        return RedisChatMessageHistory(session_id=session_id, url=self.url)
+        key = f"crawl_validators:{url}"
+        pipeline = self.redis.pipeline()
+        pipeline.delete(key)
+        pipeline.hset(key, mapping={field: value for field, value in validators.items() if value is not None})
+        pipeline.execute()
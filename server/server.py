@@ -1,3 +1,4 @@
+import itertools
 import json
 import os
 
@@ -7,8 +8,10 @@ from pydantic import BaseModel
 from datetime import datetime
 
 from knowledge.qdrant import QdrantManager, QdrantRetriever
-from knowledge.web_crawler import WebCrawler
+from knowledge.web_crawler import WebCrawler, ingestion_settings_hash
 from llm_assistant import LLMAssistant
+from llm_cache import response_cache
+from metrics import registry, start_trace
 from const import LlmNames, TextSplitters
 from redis_db import RedisManager
 
@@ -24,12 +27,16 @@ QDRANT_HOST = os.getenv('QDRANT_HOST', 'localhost')
 QDRANT_PORT = 6333
 QDRANT_URL = f"http://{QDRANT_HOST}:{QDRANT_PORT}"
 
+# Time-to-live in seconds of cached answers of temperature-0 models. 0 disables the response cache.
+LLM_CACHE_TTL = int(os.getenv('LLM_CACHE_TTL', 0))
+
 # Initialize the Flask application and enable Cross-Origin Resource Sharing (CORS)
 app = Flask(__name__)
-CORS(app, expose_headers=["X-Session-ID"])
+CORS(app, expose_headers=["X-Session-ID", "Server-Timing"])
 
 # Initialize Redis Manager
 redis_manager = RedisManager(redis_url=REDIS_URL)
+response_cache.configure(redis_manager.redis, ttl=LLM_CACHE_TTL)
 # Initialize the QdrantManager
 qdrant_manager = QdrantManager(collection_name="stored_documents", qdrant_url=QDRANT_URL)
 qdrant_retriever = QdrantRetriever(collection_name="stored_documents", qdrant_url=QDRANT_URL)
@@ -38,6 +45,17 @@ qdrant_retriever = QdrantRetriever(collection_name="stored_documents", qdrant_ur
 llm_assistant = LLMAssistant(redis_manager=redis_manager, model_name=LlmNames.CLAUDE_3_HAIKU.value, session_id=None)
 
 
+def prime_stream(stream):
+    """Consumes the stream up to its first non-empty chunk, so that everything preceding the first token has
+    been timed before the response headers are sent. Returns an iterator over the complete stream."""
+    buffered = []
+    for chunk in stream:
+        buffered.append(chunk)
+        if chunk:
+            break
+    return itertools.chain(buffered, stream)
+
+
 class Message(BaseModel):
     """Pydantic model for a message, consisting of content and type."""
     content: str
@@ -95,16 +113,27 @@ def stream_response():
     if session_id == "new_session_id":
         llm_assistant.set_session_id(datetime.now().strftime("%m/%d/%Y-%H:%M:%S"))
 
+    trace = start_trace("stream_response", model=model_name)
     if not use_news_tool:
-        response = Response(llm_assistant.stream_response(input_data, qdrant_retriever, use_rag=use_rag),
-                        content_type='text/plain')
+        stream = llm_assistant.stream_response(input_data, qdrant_retriever, use_rag=use_rag, trace=trace)
     else:
-        response = Response(llm_assistant.stream_response_agent(input_data, qdrant_retriever, use_rag=use_rag),
-                        content_type='text/plain')
+        stream = llm_assistant.stream_response_agent(input_data, qdrant_retriever, use_rag=use_rag, trace=trace)
+
+    if trace.sampled:
+        stream = prime_stream(stream)
+    response = Response(stream, content_type='text/plain')
     response.headers['X-Session-ID'] = llm_assistant.session_id
+    if trace.sampled:
+        response.headers['Server-Timing'] = trace.server_timing()
     return response
 
 
+@app.route('/metrics')
+def get_metrics():
+    """Exposes per-stage request timings and token counts in the Prometheus text format."""
+    return Response(registry.render(), content_type='text/plain; version=0.0.4')
+
+
 @app.route('/get_llm_names')
 def get_llm_names():
     """Returns a list of all available LLM names."""
@@ -131,6 +160,7 @@ def upload_website():
     context = request.form.get('context', None)
     splitter = request.form.get('splitter', None)
     splitter_args_raw = request.form.get('splitter_args', None)
+    use_sitemap = request.form.get('use_sitemap', 'true').lower() != 'false'
     splitter_args = {}
 
     if splitter_args_raw:
@@ -139,19 +169,31 @@ def upload_website():
         except json.JSONDecodeError:
             return jsonify({'error': 'Invalid splitter_args format, must be a valid JSON string'}), 400
 
-    crawler = WebCrawler(max_links=max_links)
+    crawler = WebCrawler(max_links=max_links, redis_manager=redis_manager,
+                         settings_hash=ingestion_settings_hash(context, splitter, splitter_args))
     visited_urls = {}
-    crawled_pages_count = crawler.crawl(website_url, depth, visited=visited_urls)
+    crawled_pages_count = crawler.crawl_site(website_url, depth, visited=visited_urls, use_sitemap=use_sitemap)
 
+    added_pages_count = 0
     try:
         for url, content in visited_urls.items():
-            qdrant_manager.process_content(content, url, context=context, splitter=splitter,
-                                           splitter_args=splitter_args)
+            # Pages that failed to be stored keep their old validators, so the next crawl ingests them again
+            if qdrant_manager.process_content(content, url, context=context, splitter=splitter,
+                                              splitter_args=splitter_args):
+                crawler.save_validators(url)
+                added_pages_count += 1
     except Exception as e:
         return jsonify({'error': str(e)}), 400
+    finally:
+        # Cached answers may have been built from the previous version of these pages
+        if added_pages_count:
+            response_cache.invalidate()
 
     return jsonify({
-        'message': f"{crawled_pages_count} pages were added for website {website_url}.",
+        'message': f"{added_pages_count} pages were added for website {website_url} "
+                   f"({crawled_pages_count} fetched, {len(crawler.unchanged_urls)} unchanged, "
+                   f"{crawler.duplicates_skipped} near-duplicates skipped, "
+                   f"{len(visited_urls) - added_pages_count} failed to be stored).",
     }), 200
 
 
@@ -179,8 +221,11 @@ def upload_file():
                 return jsonify({'error': 'Invalid splitter_args format, must be a valid JSON string'}), 400
 
         # Pass context, splitter, and splitter_args to process_content
-        qdrant_manager.process_content(contents, source, context=context, splitter=splitter,
-                                       splitter_args=splitter_args)
+        if not qdrant_manager.process_content(contents, source, context=context, splitter=splitter,
+                                              splitter_args=splitter_args):
+            return jsonify({'error': 'Failed to store the file content'}), 500
+        # Cached answers may have been built from the previous version of this file
+        response_cache.invalidate()
 
         return jsonify({'message': 'File content processed and vectors stored'}), 200
     else:
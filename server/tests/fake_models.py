@@ -0,0 +1,42 @@
+import threading
+import time
+from typing import Iterator, List, Optional
+
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.runnables import Runnable, RunnableConfig
+
+
+class FakeStreamingModel(Runnable):
+    """Chat model streaming scripted chunks: it waits first_token_delay before the first chunk and chunk_delay
+    before each of the others, and raises error once fail_after chunks have been sent. Records how many times
+    it was called, how many chunks it produced and whether its stream was closed."""
+
+    def __init__(self, chunks: List[str], first_token_delay: float = 0.0, chunk_delay: float = 0.0,
+                 error: Optional[Exception] = None, fail_after: int = 0):
+        self.chunks = chunks
+        self.first_token_delay = first_token_delay
+        self.chunk_delay = chunk_delay
+        self.error = error
+        self.fail_after = fail_after
+        self.temperature = 0
+        self.calls = 0
+        self.chunks_sent = 0
+        self.closed = threading.Event()
+
+    def invoke(self, input, config: Optional[RunnableConfig] = None, **kwargs) -> BaseMessage:
+        return AIMessage(content="".join(chunk.content for chunk in self.stream(input, config)))
+
+    def stream(self, input, config: Optional[RunnableConfig] = None, **kwargs) -> Iterator[AIMessageChunk]:
+        self.calls += 1
+        try:
+            for i, chunk in enumerate(self.chunks):
+                if self.error is not None and i == self.fail_after:
+                    raise self.error
+                time.sleep(self.first_token_delay if i == 0 else self.chunk_delay)
+                self.chunks_sent += 1
+                yield AIMessageChunk(content=chunk)
+            if self.error is not None and self.fail_after >= len(self.chunks):
+                raise self.error
+        finally:
+            # Reached when the stream ends, fails or is closed, as a provider's HTTP response would be
+            self.closed.set()
@@ -0,0 +1,77 @@
+import numpy as np
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from knowledge.context_packing import adaptive_cutoff, estimate_tokens, mmr_select, pack_to_budget, \
+    remove_duplicates, trim_overlaps
+
+WORDS = ("vector store retrieval latency budget chunk overlap source query answer context model token "
+         "stream cache index page crawl embed split rank").split()
+
+
+def _chunks(chunk_size=600, chunk_overlap=200):
+    rng = np.random.default_rng(0)
+    text = " ".join(rng.choice(WORDS, size=600))
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return text, splitter.split_text(text)
+
+
+def test_adaptive_cutoff_keeps_hits_close_to_the_best():
+    assert adaptive_cutoff([0.8, 0.7, 0.5, 0.2], 0.75) == 2
+    assert adaptive_cutoff([], 0.75) == 0
+
+
+def test_remove_duplicates_drops_contained_and_identical_hits():
+    vectors = np.array([[1.0, 0.0], [0.0, 1.0], [0.0, 1.0], [1.0, 1.0]])
+    texts = ["a long passage about pricing", "pricing", "another passage", "something else"]
+
+    assert remove_duplicates(texts, vectors, 0.97) == [0, 2, 3]
+    assert remove_duplicates(["first", "second", "third"], np.array([[1.0, 0.0], [1.0, 0.01], [0.0, 1.0]]),
+                             0.97) == [0, 2]
+
+
+def test_mmr_select_prefers_diverse_vectors():
+    query = np.array([1.0, 0.2])
+    vectors = np.array([[1.0, 0.0], [1.0, 0.01], [0.7, 0.7]])
+
+    assert mmr_select(query, vectors, 2, 0.5) == [1, 2]
+    assert mmr_select(query, vectors, 2, 1.0) == [1, 0]
+    assert mmr_select(query, np.empty((0, 2)), 2, 0.5) == []
+
+
+def test_trim_overlaps_removes_the_shared_text_of_neighbouring_chunks():
+    text, chunks = _chunks()
+    first, second = chunks[0], chunks[1]
+
+    trimmed = trim_overlaps([first, second], ["page", "page"])
+    assert trimmed[0] == first
+    assert len(trimmed[1]) < len(second) - 150
+    assert " ".join(trimmed) in text
+
+
+def test_trim_overlaps_handles_the_later_chunk_ranked_first():
+    text, chunks = _chunks()
+
+    trimmed = trim_overlaps([chunks[1], chunks[0]], ["page", "page"])
+    assert trimmed[0] == chunks[1]
+    assert len(trimmed[1]) < len(chunks[0]) - 150
+    assert " ".join([trimmed[1], trimmed[0]]) in text
+
+
+def test_trim_overlaps_keeps_chunks_of_other_sources_and_unrelated_chunks():
+    _, chunks = _chunks()
+
+    assert trim_overlaps([chunks[0], chunks[1]], ["page", "other page"]) == [chunks[0], chunks[1]]
+    assert trim_overlaps([chunks[0], chunks[3]], ["page", "page"]) == [chunks[0], chunks[3]]
+
+
+def test_pack_to_budget_skips_texts_that_do_not_fit():
+    texts = ["a" * 40, "b" * 80, "c" * 8]
+
+    assert pack_to_budget(texts, 25) == ["a" * 40, "c" * 8]
+
+
+def test_pack_to_budget_truncates_the_top_text():
+    packed = pack_to_budget(["a" * 400, "b" * 8], 50)
+
+    assert len(packed) == 1
+    assert estimate_tokens(packed[0]) <= 50
@@ -0,0 +1,33 @@
+import time
+import uuid
+
+from metrics import ANSWER_TAG, MetricsRegistry, RequestTrace, TraceCallbackHandler
+
+
+def test_ttft_of_a_hedged_request_includes_the_wait_for_the_primary():
+    trace = RequestTrace("chat", metrics_registry=MetricsRegistry())
+    handler = TraceCallbackHandler(trace)
+    primary, backup = uuid.uuid4(), uuid.uuid4()
+
+    handler.on_chat_model_start({}, [], run_id=primary, tags=[ANSWER_TAG])
+    time.sleep(0.1)
+    handler.on_chat_model_start({}, [], run_id=backup, tags=[ANSWER_TAG])
+    handler.on_llm_new_token("Hello", run_id=backup)
+    handler.on_llm_new_token(" world", run_id=backup)
+    handler.on_llm_end(None, run_id=backup)
+
+    assert trace.durations["ttft"] >= 0.1
+    assert trace.output_tokens == 2
+
+
+def test_runs_without_the_answer_tag_are_ignored():
+    trace = RequestTrace("chat", metrics_registry=MetricsRegistry())
+    handler = TraceCallbackHandler(trace)
+    run_id = uuid.uuid4()
+
+    handler.on_chat_model_start({}, [], run_id=run_id, tags=[])
+    handler.on_llm_new_token("Hello", run_id=run_id)
+    handler.on_llm_end(None, run_id=run_id)
+
+    assert "ttft" not in trace.durations
+    assert trace.output_tokens == 0
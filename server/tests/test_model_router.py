@@ -0,0 +1,108 @@
+import pytest
+
+from fake_models import FakeStreamingModel
+from model_router import LatencyTracker, ModelRouter
+
+PRIMARY = "primary"
+BACKUP = "backup"
+
+
+def _router(primary, backup=None, hedge_delay=0.05, hedging=True):
+    models = {PRIMARY: primary}
+    backups = {}
+    if backup is not None:
+        models[BACKUP] = backup
+        backups[PRIMARY] = BACKUP
+    tracker = LatencyTracker(default_delay=hedge_delay)
+    return ModelRouter(models, backups, tracker=tracker, hedging=hedging)
+
+
+def _answer(router, model_name=PRIMARY):
+    return "".join(chunk.content for chunk in router.get(model_name).stream("question"))
+
+
+def test_primary_answers_without_hedging_when_on_time():
+    primary = FakeStreamingModel(["primary ", "answer"])
+    backup = FakeStreamingModel(["backup ", "answer"])
+
+    assert _answer(_router(primary, backup, hedge_delay=1.0)) == "primary answer"
+    assert backup.calls == 0
+
+
+def test_hedge_wins_when_primary_is_late():
+    primary = FakeStreamingModel(["primary ", "answer"], first_token_delay=1.0)
+    backup = FakeStreamingModel(["backup ", "answer"])
+
+    assert _answer(_router(primary, backup)) == "backup answer"
+    assert primary.calls == 1
+    assert backup.calls == 1
+
+
+def test_losing_stream_is_closed_at_its_next_chunk():
+    primary = FakeStreamingModel(["primary ", "answer ", "that ", "is ", "long"], first_token_delay=0.3,
+                                 chunk_delay=0.3)
+    backup = FakeStreamingModel(["backup ", "answer"])
+
+    assert _answer(_router(primary, backup)) == "backup answer"
+    assert primary.closed.wait(timeout=5)
+    assert primary.chunks_sent == 1
+
+
+def test_fails_over_before_the_first_token():
+    primary = FakeStreamingModel(["primary"], error=ConnectionError("provider down"))
+    backup = FakeStreamingModel(["backup ", "answer"])
+
+    assert _answer(_router(primary, backup, hedging=False)) == "backup answer"
+    assert backup.calls == 1
+
+
+def test_error_after_the_first_token_is_raised():
+    primary = FakeStreamingModel(["primary ", "answer"], error=ConnectionError("connection reset"), fail_after=1)
+    backup = FakeStreamingModel(["backup ", "answer"])
+
+    with pytest.raises(ConnectionError):
+        _answer(_router(primary, backup))
+    assert backup.calls == 0
+
+
+def test_error_is_raised_without_a_backup():
+    primary = FakeStreamingModel(["primary"], error=ConnectionError("provider down"))
+
+    with pytest.raises(ConnectionError, match="provider down"):
+        _answer(_router(primary))
+
+
+def test_error_is_raised_when_the_backup_fails_too():
+    primary = FakeStreamingModel(["primary"], error=ConnectionError("primary down"))
+    backup = FakeStreamingModel(["backup"], error=TimeoutError("backup down"))
+
+    with pytest.raises((ConnectionError, TimeoutError)):
+        _answer(_router(primary, backup))
+    assert backup.calls == 1
+
+
+def test_invoke_joins_the_stream():
+    primary = FakeStreamingModel(["primary ", "answer"])
+
+    assert _router(primary).get(PRIMARY).invoke("question").content == "primary answer"
+
+
+def test_losing_backup_is_not_recorded():
+    primary = FakeStreamingModel(["primary ", "answer"], first_token_delay=0.1)
+    backup = FakeStreamingModel(["backup ", "answer"], first_token_delay=1.0)
+    router = _router(primary, backup)
+
+    assert _answer(router) == "primary answer"
+    assert router.tracker.hedge_delay(BACKUP) == router.tracker.default_delay
+    assert BACKUP not in router.tracker._samples
+
+
+def test_losing_primary_is_recorded_only_above_its_percentile():
+    tracker = LatencyTracker(min_samples=1)
+    for ttft in (1.0, 2.0, 3.0):
+        tracker.record(PRIMARY, ttft)
+
+    tracker.record_lower_bound(PRIMARY, 0.5)
+    assert list(tracker._samples[PRIMARY]) == [1.0, 2.0, 3.0]
+    tracker.record_lower_bound(PRIMARY, 5.0)
+    assert list(tracker._samples[PRIMARY]) == [1.0, 2.0, 3.0, 5.0]
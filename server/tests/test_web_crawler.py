@@ -0,0 +1,29 @@
+from knowledge.web_crawler import WebCrawler
+
+URL = "https://example.com/pricing"
+
+
+def _text(page_html):
+    return WebCrawler().extract(URL, page_html)[0]
+
+
+def test_page_wrapped_in_a_form_keeps_its_content():
+    page = ('<html><body><form id="form1"><div><h1>Pricing</h1><p>Our plan costs ten dollars a month.</p></div>'
+            '</form></body></html>')
+
+    assert _text(page) == "Pricing\nOur plan costs ten dollars a month."
+
+
+def test_small_forms_and_buttons_are_dropped():
+    page = ('<html><body><form role="search"><input name="q"><button>Search</button></form>'
+            '<h1>Pricing</h1><p>Our plan costs ten dollars a month, billed yearly.</p>'
+            '<button>Subscribe</button></body></html>')
+
+    assert _text(page) == "Pricing\nOur plan costs ten dollars a month, billed yearly."
+
+
+def test_wrappers_with_boilerplate_words_in_their_class_are_kept():
+    page = ('<html><body class="wy-body-for-nav"><div class="page-with-sidebar"><p>Real text here.</p>'
+            '<div class="sidebar">Links</div></div></body></html>')
+
+    assert _text(page) == "Real text here."
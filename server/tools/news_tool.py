@@ -15,6 +15,7 @@ from langchain_core.prompts import PromptTemplate
 from llama_index.legacy.postprocessor import FlagEmbeddingReranker
 
 import const
+from llm_cache import response_cache
 
 exa = Exa(api_key=os.environ["EXA_API_KEY"])
 
@@ -170,7 +171,7 @@ Make sure to add markdown tags to format the article.
                 language=itemgetter("language"),
             )
             | template
-            | const.Llms.ANTHROPIC_HAIKU.value
+            | response_cache.wrap(const.Llms.ANTHROPIC_HAIKU.value)
     )
 
     return chain.invoke({"topic": f"{topic}", "language": language})